@@ -1,9 +1,20 @@
 import streamlit as st
-import feedparser
-import google.generativeai as genai
-from datetime import datetime
-import time
-import sys
+from streamlit.elements import html as st_html_element
+import math
+import json
+import html
+import queue
+import asyncio
+from importlib import metadata
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from common import (
+    CSS_BLOCK, ANALYSIS_EXPIRE, FEED_TTL, GEMINI_MAX_WORKERS, INFLIGHT_TIMEOUT,
+    api_key, get_disk_cache, title_hash, analysis_cache_key, request_timeout, get_model,
+    gemini_slot_async, run_on_gemini_loop, get_rate_limiter,
+    claim_inflight, resolve_inflight,
+    get_working_model, get_six_capital_news, clear_six_capital_news,
+)
 
 # --- 設定網頁基本資訊 ---
 st.set_page_config(
@@ -12,212 +23,300 @@ st.set_page_config(
     layout="centered"
 )
 
-# --- CSS 美化樣式 ---
-st.markdown("""
-    <style>
-    body { font-family: 'Noto Sans TC', sans-serif; }
-    .news-card {
-        background-color: #ffffff;
-        padding: 20px;
-        border-radius: 10px;
-        margin-bottom: 20px;
-        border-left: 5px solid #2e86de;
-        box-shadow: 0 4px 6px rgba(0,0,0,0.1);
-        transition: transform 0.2s;
-    }
-    .news-card:hover { transform: translateY(-2px); }
-    .news-title {
-        font-size: 20px;
-        font-weight: bold;
-        color: #1f1f1f;
-        text-decoration: none;
-        display: block;
-        margin-bottom: 10px;
-    }
-    .news-title:hover { text-decoration: underline; color: #2e86de; }
-    .ai-box {
-        background-color: #f8f9fa;
-        border-radius: 8px;
-        padding: 15px;
-        margin-top: 10px;
-        border: 1px solid #e9ecef;
-    }
-    .ai-label {
-        font-weight: bold;
-        color: #6c5ce7;
-        margin-bottom: 5px;
-        font-size: 14px;
-    }
-    .model-tag {
-        background-color: #ffeaa7;
-        color: #d35400;
-        padding: 5px 10px;
-        border-radius: 5px;
-        font-size: 12px;
-        font-weight: bold;
-        margin-bottom: 20px;
-        display: inline-block;
-    }
-    .debug-info {
-        font-size: 12px;
-        color: #999;
-        margin-top: 50px;
-        text-align: center;
-        border-top: 1px solid #eee;
-        padding-top: 10px;
-    }
-    </style>
-    """, unsafe_allow_html=True)
-
-# --- 設定 AI ---
-api_key = st.secrets.get("GEMINI_API_KEY")
-if api_key:
-    genai.configure(api_key=api_key)
-
-# --- 核心功能 0：終極模型搜尋 (解決 404 問題) ---
-@st.cache_resource
-def get_working_model():
-    if not api_key:
-        return None, "未設定 API Key"
-    
-    status_text = []
-    
-    # 策略 1: 嘗試熱門模型 (優先順序)
-    candidates = [
-        "gemini-1.5-flash",
-        "gemini-1.5-pro",
-        "gemini-pro"
-    ]
-    
-    for model_name in candidates:
-        try:
-            model = genai.GenerativeModel(model_name)
-            model.generate_content("Hi")
-            return model_name, f"測試成功：{model_name}"
-        except Exception as e:
-            status_text.append(f"{model_name} ❌")
-            continue
+# --- CSS 美化樣式 (st.html 直接送出，不經過 markdown 解析) ---
+# 只有 <style> 的 st.html 要到較新版 Streamlit 才不佔版面 (issue #9388，以是否有對應的處理來判斷)；
+# 舊版照舊用 markdown 送出，避免多出一塊空白
+if hasattr(st_html_element, "_html_only_style_tags"):
+    st.html(CSS_BLOCK)
+else:
+    st.markdown(CSS_BLOCK, unsafe_allow_html=True)
 
-    # 策略 2: 如果指定名稱都失敗，直接問 API 有什麼能用的 (List Models)
-    try:
-        status_text.append("啟動自動搜尋...")
-        for m in genai.list_models():
-            if 'generateContent' in m.supported_generation_methods:
-                # 找到一個支援生成的模型，直接拿來用
-                test_name = m.name # 這裡會包含 'models/' 前綴
-                try:
-                    model = genai.GenerativeModel(test_name)
-                    model.generate_content("Hi")
-                    return test_name, f"自動搜尋成功：{test_name}"
-                except:
-                    continue
-    except Exception as e:
-        status_text.append(f"搜尋失敗: {str(e)}")
-
-    # 策略 3: 真的都不行，回傳保底 (雖然可能也會失敗)
-    return "models/gemini-pro", " | ".join(status_text)
-
-# 初始化模型
-CURRENT_MODEL_NAME, MODEL_STATUS = get_working_model()
-
-# --- 核心功能 1：抓取新聞 ---
-@st.cache_data(ttl=3600)
-def get_six_capital_news():
-    base_url = "https://news.google.com/rss/search?q="
-    query = "(房地產+OR+房市+OR+建案+OR+重劃區)+AND+(台北+OR+新北+OR+桃園+OR+台中+OR+台南+OR+高雄)+when:1d"
-    params = "&hl=zh-TW&gl=TW&ceid=TW:zh-TW"
-    feed = feedparser.parse(base_url + query + params)
-    news_items = []
-    for entry in feed.entries[:10]:
-        title = entry.title
-        link = entry.link
-        published = entry.published_parsed
-        pub_date = datetime(*published[:6]).strftime('%m/%d %H:%M') if published else "最新"
-        title_text = title.rsplit(" - ", 1)[0] if " - " in title else title
-        source = title.rsplit(" - ", 1)[1] if " - " in title else "新聞媒體"
-        news_items.append({"title": title_text, "link": link, "source": source, "date": pub_date})
-    return news_items
-
-# --- 核心功能 2：AI 分析 (4秒慢速緩衝) ---
-@st.cache_data(show_spinner=False)
-def analyze_with_ai(news_title):
-    if not api_key: return "無法分析 (缺少 API Key)"
-    
-    prompt = f"""
-    你是一位專業的台灣房地產分析師。請針對以下新聞標題進行分析：
-    新聞標題：「{news_title}」
-    請簡潔分析（各約100字）：
-    1. **【產業觀點】**：對市場的影響或趨勢。
-    2. **【受眾畫像】**：誰會對這則新聞最有感？
+# --- 核心功能 2：AI 批次分析 (標題合併成少數幾次呼叫，平行送出) ---
+MAX_BATCH_SIZE = 5  # 每批最多幾則：一批失敗或逾時，其他批照樣能顯示
+# 要求模型直接輸出 JSON，不用再靠分隔字串切段落
+JSON_CONFIG = {"response_mime_type": "application/json"}
+# 只有被 429 擋下才退避：起始 2 秒、每次加倍；平常的節流交給 gemini_slot_async 的速率限制
+RATE_LIMIT_BACKOFF = 2
+MAX_RETRY_DELAY = 60
+
+# 提示詞樣板只建一次，每批只代入則數與編號標題
+BATCH_PROMPT_TMPL = """
+    你是一位專業的台灣房地產分析師。請針對以下 {count} 則新聞標題逐一分析：
+{numbered}
+    請回傳 JSON array，依編號順序每則一個物件，欄位如下 (各約100字)：
+    - "n"：新聞編號 (整數)
+    - "industry"：【產業觀點】對市場的影響或趨勢。
+    - "audience"：【受眾畫像】誰會對這則新聞最有感？
     """
-    
+
+def build_batch_prompt(titles):
+    numbered = "\n".join(f"{i}. {t}" for i, t in enumerate(titles, 1))
+    return BATCH_PROMPT_TMPL.format(count=len(titles), numbered=numbered)
+
+def split_batches(titles):
+    # 盡量把標題平均分給所有 worker：每批越短，輸出越快結束
+    titles = list(titles)
+    size = min(MAX_BATCH_SIZE, math.ceil(len(titles) / GEMINI_MAX_WORKERS))
+    return [titles[i:i + size] for i in range(0, len(titles), size)]
+
+async def iter_json_items(response):
+    # 邊收邊解析 JSON array：每收完一個完整物件就先交出去，不用等整個陣列結束
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    async for chunk in response:
+        buf += chunk.text
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n[,":
+                pos += 1
+            if pos >= len(buf) or buf[pos] == "]":
+                break
+            try:
+                item, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                break  # 這個物件還沒收完整
+            if isinstance(item, dict):
+                yield item
+
+def rate_limit_delay(error, attempt):
+    # 伺服器在 RetryInfo 裡給了建議秒數就照著等，否則指數退避
+    for detail in getattr(error, "details", None) or []:
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None:
+            return min(delay.seconds + delay.nanos / 1e9, MAX_RETRY_DELAY)
+    return RATE_LIMIT_BACKOFF * 2 ** attempt
+
+BR = "<br>"
+
+def format_analysis(item):
+    # 分析完成當下就組成卡片可直接用的 HTML，快取的也是這個版本，畫面上不用再轉換
+    # 欄位內的換行也轉成 <br>：保留原本的分段，空行也不會提早結束卡片的 HTML 區塊
+    industry = html.escape(str(item.get("industry", "")).strip()).replace("\n", BR)
+    audience = html.escape(str(item.get("audience", "")).strip()).replace("\n", BR)
+    return f"<b>【產業觀點】</b>{industry}{BR}<b>【受眾畫像】</b>{audience}"
+
+async def analyze_batch(titles, model_name, on_item=None):
+    # 跟 SDK 一樣延後到第一次真的送請求才載入 (會帶進 grpc)
+    from google.api_core import exceptions as google_exceptions
+    prompt = build_batch_prompt(titles)
+    model = get_model(model_name)
+    timeout = request_timeout(model_name, batch=True)
     max_retries = 3
     for attempt in range(max_retries):
         try:
-            time.sleep(4) # 慢速緩衝
-            model = genai.GenerativeModel(CURRENT_MODEL_NAME)
-            response = model.generate_content(prompt)
-            return response.text
+            parts = [None] * len(titles)
+            async with gemini_slot_async():
+                response = await model.generate_content_async(prompt, stream=True, generation_config=JSON_CONFIG,
+                                                              request_options={"timeout": timeout})
+                order = -1
+                async for item in iter_json_items(response):
+                    # 兩個欄位都沒有 (例如外面多包一層物件、欄位改了名字) 就不算數：
+                    # 該則會顯示成未取得分析結果，也不會被寫進快取
+                    if not (item.get("industry") or item.get("audience")):
+                        continue
+                    order += 1
+                    # 以 "n" 對回標題；模型沒給編號就照出現順序
+                    n = item.get("n")
+                    i = n - 1 if isinstance(n, int) else order
+                    if not 0 <= i < len(titles) or parts[i] is not None:
+                        continue
+                    parts[i] = format_analysis(item)
+                    if on_item:
+                        on_item(titles[i], parts[i])
+            return [p or "⚠️ 未取得分析結果" for p in parts]
+        except (google_exceptions.DeadlineExceeded, asyncio.TimeoutError) as e:
+            # 逾時代表這次卡住了，直接重送，不需要退避
+            if attempt < max_retries - 1:
+                continue
+            return [f"⚠️ 分析逾時 ({str(e)})"] * len(titles)
         except Exception as e:
             if "429" in str(e) and attempt < max_retries - 1:
-                time.sleep(10)
+                # 讓所有批次一起暫停；重送時會在 gemini_slot_async 裡等到時間到
+                get_rate_limiter().defer(rate_limit_delay(e, attempt))
                 continue
             if attempt == max_retries - 1:
-                return f"⚠️ 分析失敗 ({str(e)})"
-    return "⚠️ 未知錯誤"
+                return [f"⚠️ 分析失敗 ({str(e)})"] * len(titles)
+    return ["⚠️ 未知錯誤"] * len(titles)
+
+async def analyze_batches(batches, model_name, on_item):
+    # 各批同時送出 (原生非同步，不必每批佔一條執行緒)，總耗時是最慢那批而不是全部加總；
+    # 某批丟出例外也不影響其他批
+    return await asyncio.gather(
+        *(analyze_batch(batch, model_name, on_item) for batch in batches),
+        return_exceptions=True,
+    )
+
+# 快取 key 只看 title_hashes (短雜湊)；底線開頭的參數 Streamlit 不會拿去算 key
+# _on_item(title, text)：每完成一則就會呼叫
+# 跨重啟的保存交給磁碟快取 (有確實的到期時間)；記憶體這層只是同一批新聞的捷徑，
+# 跟著新聞列表一起過期、限制筆數，失敗訊息也不會一直卡在畫面上
+@st.cache_data(show_spinner=False, ttl=FEED_TTL, max_entries=32)
+def analyze_all(title_hashes, model_name, _titles, _on_item=None):
+    titles = _titles
+    if not api_key: return ["無法分析 (缺少 API Key)"] * len(titles)
+    # 正規化後相同的標題共用同一個 key：只分析一次，結果回填給每個寫法
+    keys = [analysis_cache_key(t) for t in titles]
+    aliases = {}
+    for key, title in zip(keys, titles):
+        aliases.setdefault(key, []).append(title)
+
+    def emit(key, text):
+        if _on_item:
+            for title in aliases[key]:
+                _on_item(title, text)
+
+    # 先查磁碟快取，只把沒分析過的標題送給 Gemini
+    disk = get_disk_cache()
+    results = {key: disk.get(key) for key in aliases}
+    for key, text in results.items():
+        if text is not None:
+            emit(key, text)
+    missing = [key for key, text in results.items() if text is None]
+    if missing:
+        # 別的 session 正在分析的標題不重送，等它的結果就好
+        owned, waiting = claim_inflight(missing)
+        for key, fut in waiting.items():
+            fut.add_done_callback(lambda f, key=key: emit(key, f.result()))
+        mine = list(owned)
+        try:
+            if mine:
+                first = {aliases[key][0]: key for key in mine}
+                batches = split_batches(first)
+                batch_results = run_on_gemini_loop(analyze_batches(
+                    batches, model_name, lambda title, text: emit(first[title], text)))
+                texts = []
+                for batch, result in zip(batches, batch_results):
+                    if isinstance(result, Exception):
+                        result = [f"⚠️ 分析失敗 ({str(result)})"] * len(batch)
+                    texts.extend(result)
+                for key, text in zip(mine, texts):
+                    results[key] = text
+                    # 失敗訊息都以 ⚠️ 開頭，不寫進磁碟，下次還會重試
+                    if not text.startswith("⚠️"):
+                        disk.set(key, text, expire=ANALYSIS_EXPIRE)
+        finally:
+            # 不論成敗都要交付，否則等待中的 session 會一直等下去
+            for key in owned:
+                resolve_inflight(key, results[key] or "⚠️ 分析失敗 (未完成)")
+        for key, fut in waiting.items():
+            try:
+                results[key] = fut.result(timeout=INFLIGHT_TIMEOUT)
+            except FutureTimeoutError:  # Python 3.11 以前不是內建的 TimeoutError
+                results[key] = "⚠️ 分析逾時 (等待其他請求)"
+    return [results[key] for key in keys]
+
+# --- 啟動：模型搜尋與新聞下載同時進行 (兩者都是網路 I/O，互不相依) ---
+async def load_model_and_news():
+    return await asyncio.gather(
+        asyncio.to_thread(get_working_model),
+        asyncio.to_thread(get_six_capital_news),
+        return_exceptions=True,
+    )
+
+# 卡片 HTML 樣板只建一次，每張卡片只代入欄位
+CARD_TMPL = (
+    '<div class="news-card">'
+    '<a href="{link}" target="_blank" class="news-title">{title}</a>'
+    '<div style="color:#666; font-size:13px; margin-bottom:10px;">📰 {source} | 🕒 {date}</div>'
+    '<div class="ai-box">'
+    '<div class="ai-label">✨ AI 智能解析</div>'
+    '<div style="font-size: 15px; line-height: 1.6; color: #2d3436;">{analysis}</div>'
+    '</div>'
+    '</div>'
+)
+
+def card_html(news, ai_html):
+    # 標題、來源、連結都來自外部 RSS，放進 HTML 前一律跳脫 (分析內容在 format_analysis 已跳脫)
+    return CARD_TMPL.format(
+        link=html.escape(news['link'], quote=True),
+        title=html.escape(news['title']),
+        source=html.escape(news['source']),
+        date=news['date'],
+        analysis=ai_html,
+    )
 
 # --- 主程式 ---
 st.title("🧠 六都房市 AI 戰情室")
 
+# 初始化模型 (順便把新聞抓回來)
+with st.spinner('正在連線模型並下載新聞...'):
+    model_result, _ = asyncio.run(load_model_and_news())
+if isinstance(model_result, Exception):
+    raise model_result
+CURRENT_MODEL_NAME, MODEL_STATUS, MODEL_OK = model_result
+
 # 顯示模型狀態
-if "成功" in MODEL_STATUS:
+if MODEL_OK:
     st.markdown(f'<div class="model-tag">✅ {MODEL_STATUS}</div>', unsafe_allow_html=True)
 else:
     st.error(f"⚠️ 模型連線異常：{MODEL_STATUS}。請檢查 API Key 或網路狀態。")
 
 st.caption(f"資料來源：Google News | 自動節流模式")
 
-if st.button("🔄 強制刷新 (清除快取)"):
-    st.cache_data.clear()
-    st.cache_resource.clear()
-    st.rerun()
-
-try:
-    with st.spinner('正在搜尋並分析新聞... (每則需等待 4 秒)'):
-        news_data = get_six_capital_news()
-        if not news_data:
-            st.warning("目前沒有最新新聞。")
-        else:
-            progress_bar = st.progress(0)
-            for i, news in enumerate(news_data):
-                st.markdown(f"""
-                <div class="news-card">
-                    <a href="{news['link']}" target="_blank" class="news-title">{news['title']}</a>
-                    <div style="color:#666; font-size:13px; margin-bottom:10px;">
-                        📰 {news['source']} | 🕒 {news['date']}
-                    </div>
-                """, unsafe_allow_html=True)
-                
-                ai_result = analyze_with_ai(news['title'])
-                
-                st.markdown(f"""
-                    <div class="ai-box">
-                        <div class="ai-label">✨ AI 智能解析</div>
-                        <div style="font-size: 15px; line-height: 1.6; color: #2d3436;">
-                            {ai_result.replace(chr(10), '<br>')}
-                        </div>
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
-                progress_bar.progress((i + 1) / len(news_data))
-            
-            progress_bar.empty()
-            st.success("✅ 分析完成！")
-
-except Exception as e:
-    st.error(f"系統發生錯誤：{e}")
-
-# --- 顯示套件版本 (Debug用) ---
-try: ver = genai.__version__
-except: ver = "Unknown"
+# 新聞區塊獨立成 fragment：按「強制刷新」只重跑這一塊，標題、CSS、模型狀態都不用重做
+@st.fragment
+def news_panel():
+    # 按鈕在 fragment 裡，點下去本來就只重跑這一塊；清完快取直接往下重抓即可
+    if st.button("🔄 強制刷新 (清除快取)"):
+        # 新聞列表要重抓；磁碟上的 AI 分析以標題為單位，留著給相同標題沿用
+        clear_six_capital_news()
+        st.cache_data.clear()
+        st.cache_resource.clear()
+
+    try:
+        with st.spinner('正在搜尋並分析新聞... (標題分批合併、平行送出)'):
+            # 啟動時已經跟模型搜尋一起抓過，這裡通常直接命中快取；當時失敗的話會在這裡重抓並顯示錯誤
+            news_data = get_six_capital_news()
+            if not news_data:
+                st.warning("目前沒有最新新聞。")
+            else:
+                progress_bar = st.progress(0)
+                # 所有卡片合成一段 HTML、放在同一個元素裡，每次更新只送一個 delta
+                cards_slot = st.empty()
+                ai_htmls = ["⏳ AI 分析中..."] * len(news_data)
+                title_index = {}
+                for i, news in enumerate(news_data):
+                    title_index.setdefault(news['title'], []).append(i)
+
+                def render_cards():
+                    cards_slot.markdown("".join(map(card_html, news_data, ai_htmls)), unsafe_allow_html=True)
+
+                # Gemini 在背景執行緒跑，畫面更新只能在這個執行緒做，用 queue 傳回來
+                updates = queue.Queue()
+                with ThreadPoolExecutor(max_workers=1) as ex:
+                    # 同一則新聞常被多家媒體轉載：相同標題只分析一次，再套用到每張卡片
+                    titles = tuple(title_index)
+                    future = ex.submit(analyze_all, tuple(map(title_hash, titles)), CURRENT_MODEL_NAME, titles,
+                                       lambda title, text: updates.put((title, text)))
+                    filled = set()
+                    while not future.done() or not updates.empty():
+                        try:
+                            arrived = [updates.get(timeout=0.1)]
+                        except queue.Empty:
+                            continue
+                        # 一次把排隊中的結果都拿出來，合併成一次重繪
+                        while not updates.empty():
+                            arrived.append(updates.get_nowait())
+                        for title, text in arrived:
+                            for i in title_index.get(title, []):
+                                ai_htmls[i] = text
+                            filled.add(title)
+                        render_cards()
+                        progress_bar.progress(len(filled) / len(title_index))
+                    ai_results = dict(zip(titles, future.result()))
+
+                # 快取命中或沒串流到的部分，最後統一補上
+                ai_htmls = [ai_results[news['title']] for news in news_data]
+                render_cards()
+                progress_bar.empty()
+                st.success("✅ 分析完成！")
+
+    except Exception as e:
+        st.error(f"系統發生錯誤：{e}")
+
+news_panel()
+
+# --- 顯示套件版本 (Debug用；讀套件資訊就好，不必為此載入整個 SDK) ---
+try: ver = metadata.version("google-generativeai")
+except metadata.PackageNotFoundError: ver = "Unknown"
 st.markdown(f'<div class="debug-info">System: Streamlit v{st.__version__} | GenAI v{ver} (若版本低於0.7.0請更新requirements.txt)</div>', unsafe_allow_html=True)
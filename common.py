@@ -0,0 +1,495 @@
+# --- 共用模組：設定、Gemini 連線、新聞抓取 ---
+# 只在第一次 import 時執行一次；app.py 每次 rerun 都會重跑，這裡不會
+import streamlit as st
+import requests
+from requests.adapters import HTTPAdapter
+# RSS 來自外部網站：用 defusedxml 解析，擋掉實體展開之類的惡意 XML
+from defusedxml import ElementTree as ET
+from email.utils import parsedate
+from datetime import datetime
+import time
+import threading
+import logging
+import asyncio
+import hashlib
+import unicodedata
+from collections import deque
+import diskcache
+from contextlib import contextmanager, asynccontextmanager
+from functools import lru_cache
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+# --- CSS 美化樣式 ---
+CSS_BLOCK = """
+    <style>
+    body { font-family: 'Noto Sans TC', sans-serif; }
+    .news-card {
+        background-color: #ffffff;
+        padding: 20px;
+        border-radius: 10px;
+        margin-bottom: 20px;
+        border-left: 5px solid #2e86de;
+        box-shadow: 0 4px 6px rgba(0,0,0,0.1);
+        transition: transform 0.2s;
+    }
+    .news-card:hover { transform: translateY(-2px); }
+    .news-title {
+        font-size: 20px;
+        font-weight: bold;
+        color: #1f1f1f;
+        text-decoration: none;
+        display: block;
+        margin-bottom: 10px;
+    }
+    .news-title:hover { text-decoration: underline; color: #2e86de; }
+    .ai-box {
+        background-color: #f8f9fa;
+        border-radius: 8px;
+        padding: 15px;
+        margin-top: 10px;
+        border: 1px solid #e9ecef;
+    }
+    .ai-label {
+        font-weight: bold;
+        color: #6c5ce7;
+        margin-bottom: 5px;
+        font-size: 14px;
+    }
+    .model-tag {
+        background-color: #ffeaa7;
+        color: #d35400;
+        padding: 5px 10px;
+        border-radius: 5px;
+        font-size: 12px;
+        font-weight: bold;
+        margin-bottom: 20px;
+        display: inline-block;
+    }
+    .debug-info {
+        font-size: 12px;
+        color: #999;
+        margin-top: 50px;
+        text-align: center;
+        border-top: 1px solid #eee;
+        padding-top: 10px;
+    }
+    </style>
+    """
+
+# --- 設定 AI ---
+api_key = st.secrets.get("GEMINI_API_KEY")
+# 除錯用：設定 PROBE_MODELS 才會在啟動時實際連線測試各模型
+PROBE_MODELS = st.secrets.get("PROBE_MODELS")
+DEFAULT_MODEL_NAME = "gemini-1.5-flash"
+
+# google.generativeai 會連帶載入 grpc / protobuf，拖慢冷啟動；第一次真的要呼叫 Gemini 時才 import
+# genai.configure 會改動全域狀態，也只在這裡設定一次；
+# 不放進 cache_resource，以免「強制刷新」清快取後在別的執行緒請求途中被重設
+_genai = None
+_genai_lock = threading.Lock()
+
+def load_genai():
+    global _genai
+    with _genai_lock:
+        if _genai is None:
+            import google.generativeai as genai
+            if api_key:
+                genai.configure(api_key=api_key)
+            _genai = genai
+    return _genai
+
+@st.cache_resource(show_spinner=False)
+def get_model(name):
+    # 模型物件建一次就重複使用，也讓 SDK 共用底層連線
+    return load_genai().GenerativeModel(name)
+
+# --- 磁碟快取 (容器重啟、多個副本之間也能沿用，記憶體快取只在單一行程有效) ---
+CACHE_DIR = "/tmp/real-estate-news-cache"
+FEED_TTL = 600                # 新聞列表 10 分鐘內視為新鮮；之後用條件式請求確認 (來源有給 ETag / Last-Modified 時，沒更新只會拿到 304)
+FEED_STALE_TTL = 1800         # 過期後 30 分鐘內先回舊資料頂著，同時在背景重抓
+ANALYSIS_EXPIRE = 86400       # AI 分析保留 1 天 (同樣的標題隔天常常再出現)
+MODEL_EXPIRE = 86400          # 測試出來的可用模型保留 1 天 (模型清單幾週才變一次)
+MODEL_CACHE_KEY = "model:probe"
+FEED_CACHE_KEY = "feed:six-capital:swr"
+# 背景重抓的間隔：在快取過期前完成，使用者不會碰到冷快取；至少間隔 60 秒
+FEED_REFRESH_INTERVAL = max(60, FEED_TTL // 2)
+# 來源沒給 ETag / Last-Modified 時每次重抓都是完整下載，背景就放慢，不跟著 FEED_TTL 頻繁輪詢；
+# 但仍要在舊資料還能拿來頂著 (FEED_TTL + FEED_STALE_TTL) 之前抓完，留 5 分鐘餘裕
+FEED_UNCONDITIONAL_INTERVAL = max(FEED_REFRESH_INTERVAL, FEED_TTL + FEED_STALE_TTL - 300)
+
+@st.cache_resource(show_spinner=False)
+def get_disk_cache():
+    return diskcache.Cache(CACHE_DIR)
+
+def title_hash(title):
+    # 標題的短雜湊：記憶體快取與磁碟快取共用同一個 key
+    # NFKC 正規化、連續空白壓成一個、英文不分大小寫：
+    # 全形/半形、空白或大小寫不同的同一則標題 (不同轉載來源常見) 會命中同一份快取
+    normalized = " ".join(unicodedata.normalize("NFKC", title).split()).casefold()
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).hexdigest()
+
+def analysis_cache_key(title):
+    # "html-v2"：存的是已組好 <br> (欄位內換行也已轉換) 的 HTML，跟舊格式分開
+    return "analysis-html-v2:" + title_hash(title)
+
+# --- 同一則標題同時間只送一次 (多個 session 同時快取未命中時，後到的等先到的結果) ---
+INFLIGHT_TIMEOUT = 120  # 等別人的結果最多等多久，避免對方卡住時一起卡死
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+def claim_inflight(keys):
+    # 回傳 (自己負責的 {key: Future}, 別人正在算的 {key: Future})
+    owned, waiting = {}, {}
+    with _inflight_lock:
+        for key in keys:
+            if key in _inflight:
+                waiting[key] = _inflight[key]
+            else:
+                owned[key] = _inflight[key] = Future()
+    return owned, waiting
+
+def resolve_inflight(key, value):
+    # 先移出登記表再交付結果，之後進來的請求改查磁碟快取
+    with _inflight_lock:
+        fut = _inflight.pop(key, None)
+    if fut is not None:
+        fut.set_result(value)
+
+# --- 請求逾時 (略高於平均回應時間，卡住就快速重試而不是乾等 60 秒) ---
+# 各模型的逾時秒數：(單則/測試, 每批最多 5 則)
+MODEL_TIMEOUTS = {"flash": (20, 30), "pro": (45, 60)}
+
+def request_timeout(model_name, batch=False):
+    for key, (single, multi) in MODEL_TIMEOUTS.items():
+        if key in model_name:
+            return multi if batch else single
+    single, multi = MODEL_TIMEOUTS["pro"]
+    return multi if batch else single
+
+# --- Gemini 節流 (只有額度真的用完才等待，取代每次固定 sleep) ---
+GEMINI_MAX_WORKERS = 5  # 同時進行中的 Gemini 請求上限
+GEMINI_QPS = 5          # 每秒最多送出幾個請求 (gemini-1.5-flash 的額度)
+# 每分鐘最多送出幾個請求；預設是免費方案的額度，付費方案可在 secrets 調高
+GEMINI_QPM = int(st.secrets.get("GEMINI_QPM", 15))
+
+class RateLimiter:
+    def __init__(self, qps, qpm):
+        self.min_interval = 1 / qps
+        self.qpm = qpm
+        self.last = 0.0
+        self.sent = deque()  # 最近 60 秒內預約的送出時間 (由舊到新)
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        # 在鎖內預約送出時間，回傳還要等幾秒；等待放在鎖外，其他執行緒不會被卡住
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self.last + self.min_interval)
+            # 每分鐘額度用完時，排到最舊那筆滿 60 秒之後
+            if len(self.sent) >= self.qpm:
+                at = max(at, self.sent[-self.qpm] + 60)
+            while self.sent and self.sent[0] <= at - 60:
+                self.sent.popleft()
+            self.sent.append(at)
+            self.last = at
+        return at - now
+
+    def defer(self, delay):
+        # 收到 429：所有人一起暫停，而不是每個請求各自撞一次牆
+        with self._lock:
+            self.last = max(self.last, time.monotonic() + delay - self.min_interval)
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+# 整個行程共用一份，所有 session / 執行緒一起遵守同一個速率與並行上限；
+# 不放進 cache_resource，否則「強制刷新」清快取就會丟掉每分鐘的計數，新請求拿到全新額度
+_rate_limiter = RateLimiter(GEMINI_QPS, GEMINI_QPM)
+_gemini_slots = threading.Semaphore(GEMINI_MAX_WORKERS)
+
+def get_rate_limiter():
+    return _rate_limiter
+
+def get_gemini_slots():
+    return _gemini_slots
+
+@contextmanager
+def gemini_slot():
+    with get_gemini_slots():
+        get_rate_limiter().acquire()
+        yield
+
+# --- Gemini 非同步呼叫：整個行程共用一個常駐的 event loop ---
+# SDK 的非同步 gRPC 連線會綁在第一次用到它的 loop 上，每次 asyncio.run 開新 loop 就會失效；
+# 所以固定在背景執行緒跑同一個 loop。也不放進 cache_resource，「強制刷新」清快取時不會被換掉
+_gemini_loop = asyncio.new_event_loop()
+threading.Thread(target=_gemini_loop.run_forever, daemon=True).start()
+_gemini_async_slots = asyncio.Semaphore(GEMINI_MAX_WORKERS)  # 只在 _gemini_loop 上使用
+
+def run_on_gemini_loop(coro):
+    # 任何執行緒都能把協程交給 Gemini 的 loop，並等它跑完
+    return asyncio.run_coroutine_threadsafe(coro, _gemini_loop).result()
+
+@asynccontextmanager
+async def gemini_slot_async():
+    async with _gemini_async_slots:
+        await get_rate_limiter().acquire_async()
+        yield
+
+def call_gemini(model_names, prompt):
+    # 依序嘗試，第一個成功就回傳；全部失敗才把各模型的錯誤類型串起來丟出
+    errors = []
+    for name in model_names:
+        try:
+            with gemini_slot():
+                response = get_model(name).generate_content(prompt, request_options={"timeout": request_timeout(name)})
+            return name, response
+        except Exception as e:
+            errors.append(f"{name}:{type(e).__name__}")
+    raise RuntimeError(" | ".join(errors))
+
+# --- 核心功能 0：終極模型搜尋 (解決 404 問題) ---
+# 回傳 (模型名稱, 狀態說明, 是否可用)
+@st.cache_resource(show_spinner=False)
+def get_working_model():
+    if not api_key:
+        return None, "未設定 API Key", False
+    if not PROBE_MODELS:
+        # 平常直接用固定模型，省掉冷啟動時的測試請求
+        return DEFAULT_MODEL_NAME, f"使用預設模型：{DEFAULT_MODEL_NAME}", True
+    # 測試結果寫進磁碟，重啟後 1 天內直接沿用，不必再送測試請求
+    disk = get_disk_cache()
+    cached = disk.get(MODEL_CACHE_KEY)
+    if cached is not None:
+        return cached
+    result = probe_working_model()
+    if result[2]:
+        disk.set(MODEL_CACHE_KEY, result, expire=MODEL_EXPIRE)
+    return result
+
+def probe_working_model():
+    status_text = []
+    
+    # 熱門模型 (優先順序)
+    candidates = [
+        DEFAULT_MODEL_NAME,
+        "gemini-1.5-pro",
+        "gemini-pro"
+    ]
+    
+    # 策略 1: 只查模型清單 (metadata)，一次請求、不送測試提示詞也不耗額度
+    try:
+        # 名稱會包含 'models/' 前綴；用 set 查詢，每個候選只比對一次
+        names = {m.name for m in load_genai().list_models() if 'generateContent' in m.supported_generation_methods}
+        name = next((c for c in candidates if f"models/{c}" in names), None)
+        if name:
+            return name, f"模型清單確認：{name}", True
+        # 沒有偏好的模型時，挑一個 gemini 系列 (排序後取第一個，結果才固定)
+        name = next((n for n in sorted(names) if "gemini" in n.lower()), None)
+        if name:
+            return name, f"自動搜尋成功：{name}", True
+        return "models/gemini-pro", "模型清單中沒有支援生成的 Gemini 模型", False
+    except Exception as e:
+        status_text.append(f"搜尋失敗: {str(e)}")
+
+    # 策略 2: 清單查不到 (例如權限不足) 才實際送測試請求
+    try:
+        model_name, _ = call_gemini(candidates, "Hi")
+        return model_name, f"測試成功：{model_name}", True
+    except RuntimeError as e:
+        status_text.append(f"❌ {e}")
+
+    # 策略 3: 真的都不行，回傳保底 (雖然可能也會失敗)
+    return "models/gemini-pro", " | ".join(status_text), False
+
+def warm_gemini():
+    # 背景先載入 SDK、選好模型並建好模型物件，使用者第一次分析時不用再等這些
+    try:
+        if not api_key:
+            return
+        model_name, _, ok = get_working_model()
+        if ok:
+            get_model(model_name)
+    except Exception:
+        pass  # 暖機失敗不影響使用，真的要用時會再試一次並顯示錯誤
+
+# --- 核心功能 1：抓取新聞 ---
+FEED_URL = (
+    "https://news.google.com/rss/search?q="
+    "(房地產+OR+房市+OR+建案+OR+重劃區)+AND+(台北+OR+新北+OR+桃園+OR+台中+OR+台南+OR+高雄)+when:1d"
+    "&hl=zh-TW&gl=TW&ceid=TW:zh-TW"
+)
+
+FEED_DRAIN_LIMIT = 1024 * 1024  # 收滿 10 則後最多再讀多少位元組，讓連線能留在連線池
+
+@st.cache_resource(show_spinner=False)
+def get_http_session():
+    # 整個行程共用一個 Session，重複使用 TCP/TLS 連線
+    # 背景預抓和使用者當場重抓可能同時進行，連線池留幾條給並行請求，不必再開新連線
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    return session
+
+# RSS 的 pubDate 是 RFC 822 格式 (含 EST/PDT 等美國時區縮寫)，標準庫就能解析，不必動用 dateutil
+# 背景重抓時大多是同一批新聞，同樣的日期字串直接沿用上次的結果
+@lru_cache(maxsize=256)
+def format_pub_date(pub_text):
+    if not pub_text:
+        return "最新"
+    parsed = parsedate(pub_text)
+    if parsed is None:
+        return "最新"
+    try:
+        # 建 datetime 順便檢查日期是否存在 (parsedate 不會擋 2/31 這種日期)
+        return datetime(*parsed[:6]).strftime('%m/%d %H:%M')
+    except ValueError:
+        return "最新"
+
+# stale-while-revalidate：到期那一刻的使用者不用等重抓，先拿舊資料，背景再換新
+# etag / last_modified 用來發條件式請求，來源沒更新時只會拿到 304、不用重新解析
+_feed_cache = {"data": None, "fetched_at": 0.0, "etag": None, "last_modified": None, "inflight": None}
+_feed_lock = threading.Lock()
+
+def claim_feed_fetch():
+    # 呼叫時要持有 _feed_lock。同一時間只有一個抓取：回傳 (Future, 是否由自己負責抓)
+    fut = _feed_cache["inflight"]
+    if fut is not None:
+        return fut, False
+    fut = _feed_cache["inflight"] = Future()
+    return fut, True
+
+def run_feed_fetch(fut):
+    # 只有認領到的執行緒會進來；抓好新資料才一次換掉，抓的過程中其他人照樣讀得到舊的
+    try:
+        with _feed_lock:
+            prev = dict(_feed_cache)
+        if prev["data"] is None:
+            news_items, etag, last_modified = fetch_six_capital_news()
+        else:
+            news_items, etag, last_modified = fetch_six_capital_news(prev["etag"], prev["last_modified"])
+            if news_items is None:
+                news_items = prev["data"]  # 304：內容沒變，沿用手上的
+        entry = {"data": news_items, "fetched_at": time.time(), "etag": etag, "last_modified": last_modified}
+        with _feed_lock:
+            _feed_cache.update(entry)
+        get_disk_cache().set(FEED_CACHE_KEY, entry, expire=FEED_TTL + FEED_STALE_TTL)
+        fut.set_result(news_items)
+    except Exception as e:
+        fut.set_exception(e)  # 等同一份結果的人會收到同一個錯誤
+    finally:
+        # 只清自己認領的那一次，不會誤清別人的
+        with _feed_lock:
+            if _feed_cache["inflight"] is fut:
+                _feed_cache["inflight"] = None
+
+def get_six_capital_news():
+    with _feed_lock:
+        if _feed_cache["data"] is None:
+            # 行程剛啟動：先看磁碟上有沒有上次 (或其他副本) 留下的
+            cached = get_disk_cache().get(FEED_CACHE_KEY)
+            if cached is not None:
+                _feed_cache.update(cached)
+        data = _feed_cache["data"]
+        age = time.time() - _feed_cache["fetched_at"]
+        if data is not None and age < FEED_TTL:
+            return data
+        fut, owner = claim_feed_fetch()
+        if data is not None and age < FEED_TTL + FEED_STALE_TTL:
+            if owner:
+                threading.Thread(target=run_feed_fetch, args=(fut,), daemon=True).start()
+            return data
+    # 沒有資料或已經太舊，只能當場抓；別人 (例如啟動時的背景預抓) 正在抓就等同一份
+    if owner:
+        run_feed_fetch(fut)
+    return fut.result()
+
+def refresh_six_capital_news():
+    # 不管新舊都重抓一次；已經有人在抓就直接等那一次的結果
+    with _feed_lock:
+        fut, owner = claim_feed_fetch()
+    if owner:
+        run_feed_fetch(fut)
+    return fut.result()
+
+def refresh_feed_in_background():
+    try:
+        refresh_six_capital_news()
+    except Exception:
+        pass  # 背景重抓失敗就繼續用舊資料，過了容許期限會改成當場抓並顯示錯誤
+
+def clear_six_capital_news():
+    with _feed_lock:
+        _feed_cache.update(data=None, fetched_at=0.0, etag=None, last_modified=None)
+    get_disk_cache().delete(FEED_CACHE_KEY)
+
+def feed_refresh_interval():
+    with _feed_lock:
+        conditional = _feed_cache["etag"] or _feed_cache["last_modified"]
+    return FEED_REFRESH_INTERVAL if conditional else FEED_UNCONDITIONAL_INTERVAL
+
+def feed_prefetch_loop():
+    try:
+        get_six_capital_news()
+    except Exception:
+        pass  # 抓失敗就等使用者進來時再抓，錯誤會在畫面上顯示
+    while True:
+        # 任何一輪出錯都只記錄下來，執行緒不能因此結束
+        try:
+            time.sleep(feed_refresh_interval())
+            refresh_feed_in_background()
+        except Exception:
+            logger.exception("背景預抓新聞失敗")
+            time.sleep(FEED_REFRESH_INTERVAL)
+
+# 回傳 (新聞列表, ETag, Last-Modified)；伺服器回 304 時新聞列表是 None
+def fetch_six_capital_news(etag=None, last_modified=None):
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    with get_http_session().get(FEED_URL, timeout=5, headers=headers, stream=True) as resp:
+        # 記錄來源是否真的支援條件式請求 (304 / 驗證欄位)，輪詢頻率依此決定
+        logger.info("RSS %s (ETag: %s, Last-Modified: %s)", resp.status_code,
+                    "ETag" in resp.headers, "Last-Modified" in resp.headers)
+        if resp.status_code == 304:
+            return None, etag, last_modified
+        resp.raise_for_status()
+        resp.raw.decode_content = True  # 讓 urllib3 解開 gzip
+        news_items = []
+        # 邊下載邊解析，收滿 10 則就停：後面的內容不再解析、也不建整棵 DOM
+        for _, item in ET.iterparse(resp.raw, events=("end",)):
+            if item.tag != "item":
+                continue
+            title = item.findtext("title", "")
+            link = item.findtext("link", "")
+            pub_date = format_pub_date(item.findtext("pubDate"))
+            # 標題結尾的「 - 媒體名稱」只切一次
+            title_text, sep, source = title.rpartition(" - ")
+            if not sep:
+                title_text, source = title, "新聞媒體"
+            news_items.append({"title": title_text, "link": link, "source": source, "date": pub_date})
+            item.clear()
+            if len(news_items) >= 10:
+                break
+        # 沒讀完的回應關閉時 urllib3 會直接丟掉連線；剩下的內容讀完丟棄，連線才會回到連線池重用。
+        # 萬一內容大得離譜就不讀了，寧可重新連線
+        drained = 0
+        for chunk in resp.iter_content(64 * 1024):
+            drained += len(chunk)
+            if drained > FEED_DRAIN_LIMIT:
+                break
+        return news_items, resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+
+# 模組只會被 import 一次，背景預抓 / 暖機執行緒也只會各有一個
+threading.Thread(target=feed_prefetch_loop, daemon=True).start()
+threading.Thread(target=warm_gemini, daemon=True).start()